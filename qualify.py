@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import http.client
 import logging
+import os
+import shutil
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 class Warden:
     '''Launches and stands watch over a webserver process.
@@ -18,16 +25,18 @@ class Warden:
     # How long to wait for a local server response
     TIMEOUT = 0.1   # Seconds
     
-    def __init__(self, exec_args, logfile_name="webserver.log", listen_host="localhost", listen_port=5000):
+    def __init__(self, exec_args, logfile_name="webserver.log", listen_host="localhost", listen_port=5000, cwd=None):
         '''Spawn the process so it can be monitored.
         
         execargs: a list of strings suitable for use with subprocess.Popen
                     (will have ['-h', <listen_host>, '-p', <listen_port>] appended to it)
+        cwd: directory to run the webserver in (i.e., its document root); defaults to ours
         '''
         self._listen_host = listen_host
         self._listen_port = int(listen_port)    # Make sure we can increment this to avoid "address in use" errors on respawn
         self._logfile_name = logfile_name
         self._exec_args = exec_args
+        self._cwd = cwd
         
         self._proc = None
         self._respawn()
@@ -48,6 +57,7 @@ class Warden:
             self.log.info("Spawning webserver (logging to {0})".format(self._logfile_name))
             with open(self._logfile_name, "ab") as logfile:
                 self._proc = subprocess.Popen(args,
+                                cwd=self._cwd,
                                 stdin=subprocess.DEVNULL,
                                 stdout=logfile,
                                 stderr=subprocess.STDOUT)
@@ -60,23 +70,59 @@ class Warden:
         '''Internal helper to request a resource from the server.
         
         Used to qualify contestants and to ping the server for responsiveness.
-        Returns response object on success, None on failure (logs all details).
+        Returns response object on success (already closed: only its status line
+        is of interest), None on failure (logs all details).
         '''
+        conn = None
         try:
             self.log.debug("Hitting ({0}:{1}) with a 'GET {2}' request...".format(self._listen_host, self._listen_port, path))
             conn = http.client.HTTPConnection(self._listen_host, self._listen_port, timeout)
             conn.request("GET", path)
             resp = conn.getresponse()
             self.log.debug("...got {0} ({1}) response!".format(resp.status, resp.reason))
+            resp.close()
             return resp
         except socket.timeout:
             # So it's not responding...
             self.log.debug("Server did not respond (request timeout)!")
             return None
+        except ConnectionRefusedError:
+            # Not listening (yet?)
+            self.log.debug("Server refused the connection!")
+            return None
         except:
             # This is interesting...
             self.log.exception("Error requesting resource:")
             return None
+        finally:
+            if conn is not None:
+                conn.close()
+    
+    def wait_until_up(self, limit, get_path="/test.txt", interval=0.05) -> float:
+        '''Poll the (freshly spawned) server until it answers <get_path> properly; return how long that took.
+        
+        Returns None if the process died, answered with anything but a 200, or
+        <limit> seconds passed first.  Unlike .check(), never respawns anything.
+        '''
+        start = time.monotonic()
+        while True:
+            resp = self._request(get_path, self.TIMEOUT)
+            elapsed = time.monotonic() - start
+            if resp is not None:
+                # It's up, and that's its answer (retrying a 404 won't turn it into a 200)
+                if resp.status == 200:
+                    return elapsed
+                self.log.info("webserver answered {0} ({1}) instead of 200".format(resp.status, resp.reason))
+                return None
+            if self._proc.poll() is not None or elapsed >= limit:
+                return None
+            time.sleep(interval)
+    
+    def kill(self):
+        if self._proc:
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
     
     def check(self, get_path="/test.txt", timeout=TIMEOUT) -> tuple:
         '''Check the processes for both liveness and responsiveness.
@@ -110,6 +156,183 @@ class Warden:
         # All checks passed!
         return (False, None)
 
+# How long a server gets to start answering
+STARTUP_LIMIT = 10.0    # Seconds
+
+# Benchmark gate: concurrency sweep, and the (default) bar a server must clear at every level of it
+BENCH_CONCURRENCY = (1, 4, 16, 64)
+BENCH_DURATION = 2.0        # Seconds per concurrency level
+BENCH_REQUEST_TIMEOUT = 2.0 # Seconds
+MIN_RPS = 50.0
+MAX_P99 = 0.5               # Seconds
+MAX_ERROR_RATE = 0.01
+
+BenchGate = namedtuple("BenchGate", ["concurrency", "duration", "min_rps", "max_p99", "max_error_rate"])
+BenchResult = namedtuple("BenchResult", ["concurrency", "requests", "errors", "rps", "p50", "p99"])
+
+def _bench_client(address, path, deadline, latencies, errors):
+    '''One benchmark connection: fetch <path> back-to-back (a new connection each time) until <deadline>.'''
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            conn = http.client.HTTPConnection(address[0], address[1], timeout=BENCH_REQUEST_TIMEOUT)
+            try:
+                conn.request("GET", path)
+                resp = conn.getresponse()
+                resp.read()
+                ok = (resp.status == 200)
+            finally:
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            ok = False
+        if ok:
+            latencies.append(time.monotonic() - start)     # (list.append is atomic)
+        else:
+            errors.append(time.monotonic() - start)
+
+def benchmark(address, concurrency, duration, path="/test.txt") -> BenchResult:
+    '''Hammer the server at <address> with <concurrency> simultaneous clients for <duration> seconds.'''
+    latencies, errors = [], []
+    start = time.monotonic()
+    clients = [threading.Thread(target=_bench_client, args=(address, path, start + duration, latencies, errors))
+               for _ in range(concurrency)]
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    elapsed = time.monotonic() - start
+    
+    latencies.sort()
+    quantile = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else None
+    return BenchResult(concurrency, len(latencies) + len(errors), len(errors), len(latencies) / elapsed, quantile(0.5), quantile(0.99))
+
+def bench_failures(results, gate) -> list:
+    '''What (if anything) keeps these benchmark <results> from clearing <gate>, as a list of complaints.'''
+    failures = []
+    for r in results:
+        error_rate = (r.errors / r.requests) if r.requests else 1.0
+        if error_rate > gate.max_error_rate:
+            failures.append("{0} conns: {1:.1%} errors".format(r.concurrency, error_rate))
+        if r.rps < gate.min_rps:
+            failures.append("{0} conns: {1:.0f} rps".format(r.concurrency, r.rps))
+        if r.p99 is None or r.p99 > gate.max_p99:
+            failures.append("{0} conns: p99 {1}".format(r.concurrency, "-" if r.p99 is None else "{0:.0f}ms".format(r.p99 * 1000.0)))
+    return failures
+
+def run_bench(address, gate) -> list:
+    '''Run <gate>'s concurrency sweep against <address>; return the BenchResults.'''
+    return [benchmark(address, concurrency, gate.duration) for concurrency in gate.concurrency]
+
+def print_bench(results):
+    ms = lambda seconds: "-" if seconds is None else "{0:.1f}".format(seconds * 1000.0)
+    print("{0:>6}  {1:>9}  {2:>8}  {3:>8}  {4:>7}".format("conns", "req/s", "p50 ms", "p99 ms", "errors"))
+    for r in results:
+        print("{0:>6}  {1:>9.1f}  {2:>8}  {3:>8}  {4:>7.1%}".format(r.concurrency, r.rps, ms(r.p50), ms(r.p99),
+                                                                 (r.errors / r.requests) if r.requests else 1.0))
+
+def add_bench_arguments(ap):
+    ap.add_argument("--bench", default=False, action="store_true",
+                    help="After the basic check, benchmark the server (a concurrency sweep) and fail it if it falls short.")
+    ap.add_argument("--bench-concurrency", default=",".join(str(c) for c in BENCH_CONCURRENCY),
+                    help="Comma-separated numbers of simultaneous connections to sweep through.")
+    ap.add_argument("--bench-duration", type=float, default=BENCH_DURATION, help="Seconds to spend at each concurrency level.")
+    ap.add_argument("--min-rps", type=float, default=MIN_RPS, help="Fail below this many requests/second (at any level).")
+    ap.add_argument("--max-p99", type=float, default=MAX_P99 * 1000.0, help="Fail above this p99 latency, in ms (at any level).")
+    ap.add_argument("--max-error-rate", type=float, default=MAX_ERROR_RATE * 100.0, help="Fail above this percentage of failed requests (at any level).")
+
+def bench_gate(args) -> BenchGate:
+    '''The BenchGate described by add_bench_arguments()'s options (None without --bench).'''
+    if not args.bench:
+        return None
+    return BenchGate(tuple(int(c) for c in args.bench_concurrency.split(",")), args.bench_duration,
+                     args.min_rps, args.max_p99 / 1000.0, args.max_error_rate / 100.0)
+
+# Batch mode: how many ports each contestant's server may use
+BATCH_BASE_PORT = 5100
+PORTS_PER_CONTESTANT = 10
+
+def qualify_one(executable, listen_port, test_file, gate=None) -> tuple:
+    '''Qualify one contestant's webserver (in a scratch document root holding just <test_file>).
+    
+    With a BenchGate, it must also clear the gate's benchmark.
+    Returns (passed, startup_seconds, detail).
+    '''
+    with tempfile.TemporaryDirectory(prefix="qualify-") as doc_root:
+        shutil.copy(test_file, doc_root)
+        logfile_name = os.path.join(doc_root, "webserver.log")
+        try:
+            warden = Warden([executable], logfile_name=logfile_name, listen_host="localhost", listen_port=listen_port, cwd=doc_root)
+        except OSError as e:
+            return (False, None, "cannot launch: {0}".format(e.strerror))
+        try:
+            startup = warden.wait_until_up(STARTUP_LIMIT)
+            results = run_bench(warden.address, gate) if (startup is not None and gate is not None) else None
+            exit_status = warden._proc.poll()
+        finally:
+            warden.kill()
+        
+        if startup is not None and results is not None:
+            failures = bench_failures(results, gate)
+            if exit_status is not None:
+                failures.insert(0, "exited with status {0} under load".format(exit_status))
+            if failures:
+                return (False, startup, "; ".join(failures))
+            worst_p99 = max(r.p99 for r in results)
+            return (True, startup, "peak {0:.0f} rps, worst p99 {1:.1f}ms".format(max(r.rps for r in results), worst_p99 * 1000.0))
+        if startup is not None:
+            return (True, startup, "")
+        if exit_status is not None:
+            detail = "exited with status {0}".format(exit_status)
+        else:
+            detail = "no proper response to /test.txt within {0:.0f}s".format(STARTUP_LIMIT)
+        with open(logfile_name, "rb") as f:
+            last_lines = f.read().decode("utf-8", "replace").strip().splitlines()
+        if last_lines:
+            detail += ": " + last_lines[-1][:60]
+        return (False, None, detail)
+
+def qualify_batch(directory, workers=None, base_port=BATCH_BASE_PORT, gate=None) -> list:
+    '''Qualify every executable file in <directory> concurrently; return [(name, passed, startup_seconds, detail), ...].'''
+    names = sorted(name for name in os.listdir(directory)
+                   if os.path.isfile(os.path.join(directory, name)) and os.access(os.path.join(directory, name), os.X_OK))
+    test_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test.txt")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(qualify_one, os.path.abspath(os.path.join(directory, name)), base_port + i * PORTS_PER_CONTESTANT, test_file, gate)
+                   for i, name in enumerate(names)]
+        return [(name,) + future.result() for name, future in zip(names, futures)]
+
+def print_summary(results):
+    width = max([len("contestant")] + [len(name) for name, *_ in results])
+    print("{0:<{w}}  {1:<6}  {2:>8}  {3}".format("contestant", "result", "startup", "detail", w=width))
+    for name, passed, startup, detail in results:
+        print("{0:<{w}}  {1:<6}  {2:>8}  {3}".format(name, "PASS" if passed else "FAIL",
+                                                    "-" if startup is None else "{0:.2f}s".format(startup), detail, w=width))
+    print("\n{0} of {1} qualified".format(sum(1 for _, passed, *_ in results if passed), len(results)))
+
+def batch_main(argv):
+    import argparse
+    
+    ap = argparse.ArgumentParser(prog="qualify.py --batch", description="Qualify a whole directory of contestant webservers at once.")
+    ap.add_argument("directory", help="Folder of contestant webserver executables (one per contestant, named for them).")
+    ap.add_argument("-j", "--jobs", type=int, default=None,
+                    help="Number of servers to qualify at a time (default: one per CPU, or 1 with --bench so the numbers are fair).")
+    ap.add_argument("-p", "--base-port", type=int, default=BATCH_BASE_PORT,
+                    help="First port to hand out (each contestant gets {0} of their own).".format(PORTS_PER_CONTESTANT))
+    add_bench_arguments(ap)
+    args = ap.parse_args(argv)
+    gate = bench_gate(args)
+    jobs = args.jobs if (args.jobs or gate is None) else 1
+    
+    start = time.monotonic()
+    results = qualify_batch(args.directory, jobs, args.base_port, gate)
+    if not results:
+        print("\n*** ERROR: no executables found in '{0}'".format(args.directory), file=sys.stderr)
+        sys.exit(1)
+    print_summary(results)
+    print("(in {0:.1f}s)".format(time.monotonic() - start))
+    if not all(passed for _, passed, *_ in results):
+        sys.exit(1)
+
 INSTRUCTIONS = """\
 Instructions:
 
@@ -123,19 +346,48 @@ Instructions:
     ./qualify.py ./webserver
     
     The program will tell you whether or not your server "qualifies."
+    
+    To see how it holds up under load, too (see --help for the bar it must clear):
+    
+    ./qualify.py --bench ./webserver
+
+    (Instructors: "./qualify.py --batch FOLDER" qualifies every executable
+    in FOLDER at once and prints a summary table.)
 """
         
 def main(argv):
     if len(argv) == 1:
         print(INSTRUCTIONS)
         return
+    if argv[1] == "--batch":
+        batch_main(argv[2:])
+        return
     
-    warden = Warden(argv[1:], listen_host="localhost", listen_port=5005)
-    down, status = warden.check(timeout=10.0)    # Give the server process longer to spin up before the first ping
-    if down:
+    import argparse
+    
+    ap = argparse.ArgumentParser(prog="qualify.py", description="Check whether a webserver qualifies for the Wars.")
+    add_bench_arguments(ap)
+    ap.add_argument("execargs", nargs=argparse.REMAINDER, help="Command[s] to launch webserver (without -h/-p options).")
+    args = ap.parse_args(argv[1:])
+    if not args.execargs:
+        print(INSTRUCTIONS)
+        return
+    
+    warden = Warden(args.execargs, listen_host="localhost", listen_port=5005)
+    if warden.wait_until_up(STARTUP_LIMIT) is None:    # Give the server process a while to spin up
         print("\n*** ERROR: the webserver was not successfully launched (or isn't properly configured to serve up /test.txt)", file=sys.stderr)
         sys.exit(1)
     
+    gate = bench_gate(args)
+    if gate is not None:
+        print("\n*** Benchmarking ({0:g}s per level)...\n".format(gate.duration))
+        results = run_bench(warden.address, gate)
+        print_bench(results)
+        failures = bench_failures(results, gate)
+        if failures:
+            print("\n*** ERROR: the webserver does not hold up under load ({0})".format("; ".join(failures)), file=sys.stderr)
+            sys.exit(1)
+    
     print("\n*** OK! Your webserver should qualify for the Wars...")
 
 if __name__ == "__main__":
@@ -17,7 +17,7 @@ ipToUsername = {}
 killLog = []
 
 def makeStats(ip):
-    return {'ip': ip, 'status': 'Offline', 'attacks': 0, 'kills': [], 'survives': 0, 'killedby': []}
+    return {'ip': ip, 'status': 'Offline', 'latency': '', 'resources': '', 'rejected': '', 'attacks': 0, 'kills': [], 'survives': 0, 'killedby': []}
 
 class ProbeThread(Thread):
     def __init__(self, register_file, warlog):
@@ -51,7 +51,17 @@ class ProbeThread(Thread):
 
         stats = warriorStats[sourceUser]
         if msgType == 'STATUS':
-            stats['status'] = msgInfo
+            # e.g., "Online;ewma=1.2ms,p50=1.1ms,p99=3.0ms,n=40,hang=100.0ms"
+            status, _, latency = msgInfo.partition(';')
+            stats['status'] = status
+            stats['latency'] = latency
+        elif msgType == 'RESOURCES':
+            # e.g., "pid=123,state=S,cpu=2%,cputime=0.10s,rss=20.1MB,threads=2,fds=5/1024[,hang=spinning]"
+            stats['resources'] = msgInfo
+        elif msgType == 'REJECTED':
+            # e.g., "10.0.0.5:queued=12,rate=40" (connections over quota since the last report)
+            attackerIp, _, counts = msgInfo.partition(':')
+            stats['rejected'] = f'rejected {attackerIp}: {counts}'
         elif msgType == 'ATTACK':
             [attackerIp, result] = msgInfo.split(':')
             if result == 'OK':
@@ -122,7 +132,8 @@ def home():
         stats = localStats[warrior]
         ip = stats['ip']
         status = stats['status']
-        status = f'<span class="{status}">{status}</span>'
+        latency = ' '.join(filter(None, [stats['latency'], stats['resources'], stats['rejected']]))
+        status = f'<span class="{status}" title="{latency}">{status}</span>'
         attacks = stats['attacks']
         kills = len(stats['kills'])
         survives = stats['survives']
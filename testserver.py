@@ -7,6 +7,7 @@ import argparse
 import http.server
 import logging
 import os
+import socket
 import socketserver
 import threading
 import time
@@ -63,8 +64,13 @@ class TestHandler(http.server.BaseHTTPRequestHandler):
         logging.info(fmt%args)
 
 class TestServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
-    def __init__(self, server_address, RequestHandlerClass, doc_root, max_workers):
-        super().__init__(server_address, RequestHandlerClass)
+    def __init__(self, server_address, RequestHandlerClass, doc_root, max_workers, listen_socket=None):
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate=(listen_socket is None))
+        if listen_socket is not None:
+            # Serve on an inherited, already-listening socket instead of binding our own
+            self.socket.close()
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
         self._doc_root = os.path.realpath(doc_root)
         self._max_workers = max_workers
         self._worker_count = 0
@@ -88,6 +94,13 @@ class TestServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
                 logging.info("New request (from {0}); {1} workers active...".format(client_address, self._worker_count))
                 return True
 
+def inherited_socket():
+    """The listening socket handed to us systemd-style (LISTEN_FDS/LISTEN_PID), if any."""
+    if os.environ.get("LISTEN_PID") != str(os.getpid()) or int(os.environ.get("LISTEN_FDS", "0")) < 1:
+        return None
+    logging.info("Using inherited listening socket (fd 3)")
+    return socket.socket(fileno=3)
+
 def main():
     logging.basicConfig(level=logging.INFO)
     
@@ -99,7 +112,7 @@ def main():
     args = ap.parse_args()
     print(args)
     
-    TestServer((args.host, args.port), TestHandler, args.root, args.workers).serve_forever()
+    TestServer((args.host, args.port), TestHandler, args.root, args.workers, inherited_socket()).serve_forever()
 
 if __name__ == "__main__":
     main()
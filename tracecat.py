@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""warproxy Trace Decoder
+
+Prints what a warproxy's event trace (see --trace) recorded around a verdict,
+for settling disputes over who KILLED whom.
+
+    ./tracecat.py [warproxy.trace] --list
+    ./tracecat.py [warproxy.trace] [--attacker 10.0.0.5] [--result KILL] [--seconds 10]
+    ./tracecat.py [warproxy.trace] --tail [--seconds 10]
+"""
+import argparse
+import sys
+import time
+
+import warproxy
+
+
+def details(r) -> str:
+    '''The event-specific part of record <r>, spelled out.'''
+    kind, a, b = r.kind, r.a, r.b
+    if kind == "OVERQUOTA":
+        return "queued={0} active={1}".format(a, b)
+    elif kind == "ENQUEUE":
+        return "queued={0}".format(a)
+    elif kind == "FORWARD":
+        return "attack conns={0}".format(a)
+    elif kind == "CLOSE":
+        return "up={0}B down={1}B".format(a, b)
+    elif kind == "TIMEOUT":
+        return "dropped={0}".format(a)
+    elif kind == "PROBE":
+        return "status={0} {1:.3f}ms".format(a or "none", b / 1000.0)
+    elif kind in ("SPAWN", "PROMOTE"):
+        return "port={0} pid={1}".format(a, b)
+    elif kind == "DIED":
+        return "status={0} pid={1}".format(a, b)
+    elif kind == "BOUNCE":
+        return "status={0} pid={1}".format(a or "none", b)
+    elif kind == "VERDICT":
+        result = warproxy.TRACE_VERDICTS[a] if 0 <= a < len(warproxy.TRACE_VERDICTS) else str(a)
+        return result + (" (exit code: {0})".format(b) if result == "KILL" else "")
+    return ""
+
+
+def timestamp(time_ns) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time_ns // 10**9)) + ".{0:06d}".format(time_ns % 10**9 // 1000)
+
+
+def arena(source) -> str:
+    '''Which tenant/slot a source ("judge.alice.1", "warden", ...) belongs to.'''
+    return source.partition(".")[2]
+
+
+def tenant(source) -> str:
+    '''Which tenant a source belongs to, whatever its slot ("alice" for "judge.alice.1"; "" for "judge.1").'''
+    parts = arena(source).split(".")
+    if parts[-1].isdigit():
+        parts.pop()
+    return ".".join(parts)
+
+
+def relevant(records, verdict, all_sources=False) -> list:
+    '''The <records> that bear on <verdict>: those of its own arena, plus the attacker's own in the same tenant.
+
+    (With attack slots, slot 0's umpire accepts and queues an attacker that
+    another slot then forwards and judges.)
+    '''
+    if all_sources:
+        return list(records)
+    return [r for r in records if arena(r.source) == arena(verdict.source)
+            or (r.attacker == verdict.attacker and tenant(r.source) == tenant(verdict.source))]
+
+
+def print_records(records, anchor_ns):
+    for r in records:
+        print("{0}  {1:+11.6f}  {2:<16} {3:<9} {4:<15} {5}".format(timestamp(r.time_ns), (r.time_ns - anchor_ns) / 1e9,
+                                                               r.source, r.kind, r.attacker or "-", details(r)))
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description="Print what a warproxy event trace recorded around a verdict.")
+    ap.add_argument("trace", nargs="?", default="warproxy.trace", help="Trace file (warproxy --trace).")
+    ap.add_argument("-l", "--list", default=False, action="store_true", help="List the verdicts in the trace.")
+    ap.add_argument("-a", "--attacker", default=None, help="Show the verdict on this attacker's attack.")
+    ap.add_argument("-r", "--result", choices=["OK", "KILL", "HUNG"], default=None, help="Show a verdict with this result.")
+    ap.add_argument("-n", "--nth", type=int, default=1, help="Show the Nth most recent such verdict.")
+    ap.add_argument("-s", "--seconds", type=float, default=10.0, help="Show this many seconds of events leading up to it.")
+    ap.add_argument("--after", type=float, default=1.0, help="...and this many seconds after it.")
+    ap.add_argument("--all-sources", default=False, action="store_true",
+                    help="Include other contestants'/slots' events (normally just the verdict's own arena, "
+                         "plus its attacker's events in the contestant's other slots).")
+    ap.add_argument("--tail", default=False, action="store_true", help="Show the last --seconds of the trace, verdict or not.")
+    args = ap.parse_args(argv[1:])
+
+    try:
+        records = warproxy.read_trace(args.trace)
+    except (OSError, ValueError) as e:
+        print("*** ERROR: {0}".format(e), file=sys.stderr)
+        sys.exit(1)
+    if not records:
+        print("(the trace is empty)")
+        return
+    print("{0} events from {1} to {2}".format(len(records), timestamp(records[0].time_ns), timestamp(records[-1].time_ns)))
+
+    verdicts = [r for r in records if r.kind == "VERDICT"]
+    if args.list:
+        for r in verdicts:
+            print("{0}  {1:<16} {2:<15} {3}".format(timestamp(r.time_ns), r.source, r.attacker, details(r)))
+        return
+
+    if args.tail:
+        anchor = records[-1]
+        shown = [r for r in records if r.time_ns >= anchor.time_ns - args.seconds * 1e9]
+        print_records(shown, anchor.time_ns)
+        return
+
+    if args.attacker is not None:
+        verdicts = [r for r in verdicts if r.attacker == args.attacker]
+    if args.result is not None:
+        verdicts = [r for r in verdicts if details(r).startswith(args.result)]
+    if len(verdicts) < args.nth:
+        print("*** ERROR: no such verdict in the trace (see --list)", file=sys.stderr)
+        sys.exit(1)
+    verdict = verdicts[-args.nth]
+    start, end = verdict.time_ns - args.seconds * 1e9, verdict.time_ns + args.after * 1e9
+    shown = relevant([r for r in records if start <= r.time_ns <= end], verdict, args.all_sources)
+    print("{0}'s attack: {1}".format(verdict.attacker, details(verdict)))
+    if start < records[0].time_ns and records[0].seq > 1:
+        print("(the trace has wrapped around: it only goes back {0:.3f}s before the verdict)".format((verdict.time_ns - records[0].time_ns) / 1e9))
+    print()
+    print_records(shown, verdict.time_ns)
+
+
+def test_relevant():
+    rec = lambda source, kind, attacker="": warproxy.TraceRecord(1, 0, kind, source, attacker, 0, 0)
+    records = [rec("umpire.alice", "ACCEPT", "10.0.0.5"), rec("umpire.alice", "ENQUEUE", "10.0.0.5"),
+               rec("umpire.alice", "FORWARD", "10.0.0.6"), rec("umpire.bob", "ACCEPT", "10.0.0.5"),
+               rec("warden.alice.1", "PROBE"), rec("umpire.alice.1", "FORWARD", "10.0.0.5"),
+               rec("judge.alice.1", "VERDICT", "10.0.0.5")]
+    verdict = records[-1]
+    # Slot 0 accepted and queued the attacker slot 1 judged; nobody else's events (nor other tenants') come along
+    assert relevant(records, verdict) == records[:2] + records[4:]
+    assert relevant(records, verdict, all_sources=True) == records
+
+    # Likewise for the command-line tenant (no name)
+    records = [rec("umpire", "ACCEPT", "10.0.0.5"), rec("umpire", "FORWARD", "10.0.0.6"), rec("judge.1", "VERDICT", "10.0.0.5")]
+    assert relevant(records, records[-1]) == [records[0], records[2]]
+    assert [tenant(s) for s in ("judge", "judge.1", "judge.alice", "judge.alice.1")] == ["", "", "alice", "alice"]
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""warproxy Benchmarks
+
+Micro-benchmarks for the warproxy's hot paths.
+
+    ./warbench.py loop [--sizes 100,1000,5000,20000]
+    ./warbench.py turnstile [--attackers 10000]
+    ./warbench.py relay [--megabytes 200] [--chunk 4096]
+"""
+import argparse
+import os
+import socket
+import sys
+import time
+
+import warproxy
+from warproxy import asyncore
+
+
+class IdleDispatcher(warproxy._dispatcher):
+    '''An always-readable dispatcher on a descriptor that never becomes ready (an eventfd).
+
+    Stands in for an idle proxied connection while costing only one descriptor.
+    '''
+    def __init__(self, map):
+        super().__init__(map=map)
+        self._fd = os.eventfd(0)
+        self._fileno = self._fd
+        self.add_channel(map)
+
+    def close(self):
+        super().close()
+        os.close(self._fd)
+
+    def handle_read(self):
+        pass
+
+    def writable(self):
+        return False
+
+
+class PingDispatcher(warproxy._dispatcher):
+    '''One end of a socketpair that reads whatever the benchmark writes to the other end.'''
+    def __init__(self, sock, map):
+        super().__init__(sock, map=map)
+        self.hits = 0
+
+    def handle_read(self):
+        self.recv(64)
+        self.hits += 1
+
+    def writable(self):
+        return False
+
+
+def time_loop(poll, peer, pinger, iterations):
+    '''Average seconds per loop pass that services exactly one ready connection.'''
+    start = time.perf_counter()
+    for _ in range(iterations):
+        peer.send(b"x")
+        poll()
+    elapsed = time.perf_counter() - start
+    assert pinger.hits >= iterations
+    return elapsed / iterations
+
+
+def bench_loop(sizes, iterations):
+    fd_limit = warproxy.raise_fd_limit()
+    print("{0:>8}  {1:>16}  {2:>16}".format("idle", "SelectorLoop", "asyncore.loop"))
+    for n in sizes:
+        if n + 64 > fd_limit:
+            print("{0:>8}  (skipped: open-file limit is {1})".format(n, fd_limit))
+            continue
+
+        # SelectorLoop
+        loop = warproxy.SelectorLoop()
+        idle = [IdleDispatcher(loop.map) for _ in range(n)]
+        a, b = socket.socketpair()
+        pinger = PingDispatcher(a, loop.map)
+        loop.poll(0)    # Initial registration is not part of the steady state
+        sel_cost = time_loop(lambda: loop.poll(1.0), b, pinger, iterations)
+        for d in idle + [pinger]:
+            d.close()
+        b.close()
+        loop.close()
+
+        # Stock asyncore.loop (select) for comparison, where select() can even handle it
+        if n + 16 < 1024:
+            smap = {}
+            idle = [IdleDispatcher(smap) for _ in range(n)]
+            a, b = socket.socketpair()
+            pinger = PingDispatcher(a, smap)
+            ac_cost = time_loop(lambda: asyncore.loop(1.0, count=1, map=smap), b, pinger, iterations)
+            for d in idle + [pinger]:
+                d.close()
+            b.close()
+            ac_text = "{0:>13.1f} us".format(ac_cost * 1e6)
+        else:
+            ac_text = "{0:>16}".format("FD_SETSIZE!")
+
+        print("{0:>8}  {1:>13.1f} us  {2}".format(n, sel_cost * 1e6, ac_text))
+
+
+class LinearTurnstile:
+    '''The original min()/list.remove() AttackTurnstile, kept for comparison.'''
+    def __init__(self):
+        self._src_map = {}
+
+    def enqueue_conn(self, attacker, conn, timestamp):
+        try:
+            self._src_map[attacker].queue.append(conn)
+        except KeyError:
+            self._src_map[attacker] = warproxy.AttackQueue(timestamp, attacker, [conn])
+
+    def drop_conn(self, attacker, conn):
+        self._src_map[attacker].queue.remove(conn)
+        if not self._src_map[attacker].queue:
+            del self._src_map[attacker]
+            return True
+        return False
+
+    def dequeue_conns(self):
+        aq = min(self._src_map.values())
+        del self._src_map[aq.attacker]
+        return (aq.attacker, aq.queue)
+
+
+def time_turnstile(cls, attackers, conns):
+    '''(enqueue, drop, dequeue) average seconds per operation with <attackers> queued.'''
+    ats = cls()
+    names = ["10.0.{0}.{1}".format(i // 256, i % 256) for i in range(attackers)]
+
+    start = time.perf_counter()
+    for c in range(conns):
+        for i, name in enumerate(names):
+            ats.enqueue_conn(name, (name, c), float(i))
+    enqueue = (time.perf_counter() - start) / (attackers * conns)
+
+    # Drop every attacker's first connection (the worst case for list.remove is its last, but
+    # the first is what happens when an impatient attacker gives up early)
+    start = time.perf_counter()
+    for name in names:
+        ats.drop_conn(name, (name, 0))
+    drop = (time.perf_counter() - start) / attackers
+
+    # Time a batch of dequeues while the turnstile is still (nearly) full
+    batch = min(1000, attackers)
+    start = time.perf_counter()
+    for _ in range(batch):
+        ats.dequeue_conns()
+    dequeue = (time.perf_counter() - start) / batch
+    return (enqueue, drop, dequeue)
+
+
+def bench_turnstile(attackers, conns):
+    print("{0} queued attackers x {1} connections each".format(attackers, conns))
+    print("{0:>16}  {1:>12}  {2:>12}  {3:>12}".format("", "enqueue", "drop", "dequeue"))
+    for label, cls in (("AttackTurnstile", warproxy.AttackTurnstile), ("min()/list", LinearTurnstile)):
+        costs = time_turnstile(cls, attackers, conns)
+        print("{0:>16}  {1}".format(label, "  ".join("{0:>9.2f} us".format(c * 1e6) for c in costs)))
+
+
+class SinkDispatcher(warproxy._dispatcher):
+    '''Target-side end of a relayed connection: reads and discards everything, counting bytes.'''
+    def __init__(self, sock, map, bench):
+        super().__init__(sock, map=map)
+        self.bench = bench
+
+    def handle_read(self):
+        data = self.recv(256 * 1024)
+        self.bench.received += len(data)
+
+    def writable(self):
+        return False
+
+
+class TargetServer(warproxy._dispatcher):
+    '''Stands in for the webserver: accepts connections into SinkDispatchers.'''
+    def __init__(self, map, bench):
+        super().__init__(map=map)
+        self.bench = bench
+        self.create_socket()
+        self.bind(("127.0.0.1", 0))
+        self.listen(5)
+
+    def handle_accepted(self, sock, addr):
+        SinkDispatcher(sock, self._map, self.bench)
+
+
+class PumpDispatcher(warproxy._dispatcher):
+    '''Attacker-side end: writes <chunk>-sized blocks into the proxy until <total> bytes are out.'''
+    def __init__(self, address, map, chunk, total):
+        super().__init__(map=map)
+        self.block = b"x" * chunk
+        self.left = total
+        self.create_socket()
+        self.connect(address)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.block[:self.left])
+        self.left -= sent
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return self.left > 0
+
+
+class PhonyWarden:
+    def __init__(self, address):
+        self.address = address
+        self.latency = warproxy.LatencyEstimator()
+
+
+class ForwardingUmpire:
+    '''Forwards every connection at once.'''
+    def handle_accepted(self, dispatcher, current_time=None):
+        dispatcher.forward()
+
+    def handle_closed(self, dispatcher, current_time=None):
+        pass
+
+
+def time_relay(chunk, total, splice=False):
+    '''(wall, CPU) seconds for the proxy (on a SelectorLoop) to relay <total> bytes written in <chunk>-sized blocks.
+
+    (The pump and the sink run on the same loop, so the CPU time covers both ends
+    too; it is steadier than wall time, though, on a busy machine.)
+    '''
+    bench = argparse.Namespace(received=0)
+    loop = warproxy.SelectorLoop()
+    target = TargetServer(loop.map, bench)
+    proxy = warproxy.ProxyServer(("127.0.0.1", 0), PhonyWarden(target.socket.getsockname()), ForwardingUmpire(),
+                                 map=loop.map, splice=splice)
+    PumpDispatcher(proxy.socket.getsockname(), loop.map, chunk, total)     # (Registers itself in loop.map)
+    start, start_cpu = time.perf_counter(), time.process_time()
+    while bench.received < total:
+        loop.poll(1.0)
+    elapsed, elapsed_cpu = time.perf_counter() - start, time.process_time() - start_cpu
+    for d in list(loop.map.values()):
+        d.close()
+    loop.close()
+    return (elapsed, elapsed_cpu)
+
+
+def bench_relay(megabytes, chunk, repeats):
+    total = megabytes * 1024 * 1024
+    time_relay(chunk, total // 10)  # Warm-up
+    print("{0} MB in {1}-byte writes, best of {2}".format(megabytes, chunk, repeats))
+    print("{0:>10}  {1:>12}  {2:>18}".format("", "throughput", "CPU per 4 KiB"))
+    for label, splice in (("recv/send", False), ("splice", True)):
+        if splice and not warproxy.SPLICE_AVAILABLE:
+            continue
+        runs = [time_relay(chunk, total, splice) for _ in range(repeats)]
+        wall = min(w for w, _ in runs)
+        cpu = min(c for _, c in runs)
+        print("{0:>10}  {1:>7.1f} MB/s  {2:>15.2f} us".format(label, megabytes / wall, cpu / (total / 4096) * 1e6))
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description="warproxy micro-benchmarks")
+    sub = ap.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("loop", help="Cost of one event-loop pass vs. number of idle connections.")
+    p.add_argument("--sizes", default="100,1000,5000,20000", help="Comma-separated idle connection counts.")
+    p.add_argument("-i", "--iterations", type=int, default=2000, help="Loop passes to time per size.")
+
+    p = sub.add_parser("turnstile", help="Cost of AttackTurnstile operations with many queued attackers.")
+    p.add_argument("-a", "--attackers", type=int, default=10000, help="Number of distinct queued attackers.")
+    p.add_argument("-c", "--conns", type=int, default=3, help="Queued connections per attacker.")
+
+    p = sub.add_parser("relay", help="Proxy relay throughput (attacker -> target) on one SelectorLoop.")
+    p.add_argument("-m", "--megabytes", type=int, default=200, help="Megabytes to relay per run.")
+    p.add_argument("-c", "--chunk", type=int, default=4096, help="Bytes per attacker-side write.")
+    p.add_argument("-r", "--repeats", type=int, default=3, help="Runs to take the best of.")
+
+    args = ap.parse_args(argv[1:])
+    if args.bench == "loop":
+        bench_loop([int(n) for n in args.sizes.split(",")], args.iterations)
+    elif args.bench == "turnstile":
+        bench_turnstile(args.attackers, args.conns)
+    elif args.bench == "relay":
+        bench_relay(args.megabytes, args.chunk, args.repeats)
+
+if __name__ == "__main__":
+    main(sys.argv)